@@ -0,0 +1,102 @@
+"""
+Check of the on-disk bucketing of reddit.cascades. Writes a synthetic comment dump, computes the cascade statistics
+with small max_records values, and compares them with a brute-force computation of size, depth and breadth. The
+thread ids are multiples of a highly composite number, so threads keep landing in the same sub-bucket and buckets
+are split several levels deep (the deepest split is reported). Exits with code 1 on a mismatch.
+
+Usage:
+	python benchmarks/cascades_buckets.py
+	python benchmarks/cascades_buckets.py --comments 20000 --threads 50 --max-records 2000 500 50 5
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reddit import cascades
+import numpy as np
+
+
+def synthetic_dump(file, n_comments, n_threads, seed=0):
+	"""Writes a comment dump of random threads, returning {link_id: {comment_id: parent_id}}."""
+
+	rng = np.random.default_rng(seed)
+	threads = {}
+	with open(file, 'w') as f:
+		for i in range(1, n_comments + 1):
+			link = np.base_repr(int(rng.integers(1, n_threads + 1)) * 720720 * 1024, 36).lower()
+			comment = np.base_repr(i, 36).lower()
+			thread = threads.setdefault(link, {})
+			if thread and rng.random() < 0.8:
+				parent = 't1_' + list(thread)[int(rng.integers(len(thread)))]
+			else:
+				parent = 't3_' + link
+			thread[comment] = parent
+			f.write(json.dumps({'id': comment, 'link_id': 't3_' + link, 'parent_id': parent, 'subreddit': 'test'})
+			        + '\n')
+
+	return threads
+
+
+def brute_force(threads):
+	"""Computes {link_id: (size, depth, breadth)} by walking up each comment's parents."""
+
+	results = {}
+	for link, thread in threads.items():
+		depths = {}
+		for comment in thread:
+			depth, node = 0, comment
+			while node in thread:
+				depth, node = depth + 1, thread[node][3:]
+			depths[comment] = depth
+		levels = Counter(depths.values())
+		results[link] = (len(thread), max(levels), max(levels.values()))
+
+	return results
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Checks reddit.cascades against a brute-force computation.')
+	parser.add_argument('--comments', type=int, default=3000, help='number of comments')
+	parser.add_argument('--threads', type=int, default=20, help='number of threads')
+	parser.add_argument('--n-buckets', type=int, default=4, help='number of first-level buckets')
+	parser.add_argument('--max-records', type=int, nargs='*', default=[2000, 500, 50, 5],
+	                    help='max_records values to check')
+	args = parser.parse_args(argv)
+
+	failed = False
+	with tempfile.TemporaryDirectory() as tmpdir:
+		file = os.path.join(tmpdir, 'RC_test')
+		expected = brute_force(synthetic_dump(file, args.comments, args.threads))
+
+		# Records the deepest bucket split, by wrapping the recursive bucket processing
+		process_bucket = cascades._process_bucket
+		levels = []
+
+		def process_bucket_tracked(bucket, *bucket_args):
+			levels.append(bucket.count('_split'))
+			return process_bucket(bucket, *bucket_args)
+
+		cascades._process_bucket = process_bucket_tracked
+
+		for max_records in args.max_records:
+			levels.clear()
+			time_start = time.time()
+			df = cascades.cascades_dump(file, n_buckets=args.n_buckets, max_records=max_records, tmpdir=tmpdir)
+			result = {row.link_id: (row.size, row.depth, row.breadth) for row in df.itertuples()}
+			ok = result == expected
+			failed = failed or not ok
+			print('max_records={:d}: {:d} threads in {:0.2f} s, {:d} split levels, {:s}'.format(
+				max_records, len(result), time.time() - time_start, max(levels), 'ok' if ok else 'MISMATCH'))
+
+	return 1 if failed else 0
+
+
+if __name__ == '__main__':
+	raise SystemExit(main())
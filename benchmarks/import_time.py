@@ -0,0 +1,79 @@
+"""
+Import-time benchmark. Imports the package (and optionally submodules) in a fresh interpreter and reports the import
+time, the peak resident memory and the heavy third-party modules that were loaded. Exits with code 1 if a limit is
+exceeded, so it can guard startup latency in CI or before deploying batch workers.
+
+Usage:
+	python benchmarks/import_time.py
+	python benchmarks/import_time.py --modules datasets analysis --max-time 5 --max-rss 300
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Modules that must not be loaded by a bare "import reddit"
+heavy_modules = ['matplotlib', 'seaborn', 'powerlaw', 'pymongo', 'tables', 'requests', 'pandas', 'numpy']
+
+child_code = '''
+import json, resource, sys, time
+time_start = time.perf_counter()
+import reddit
+for name in {modules!r}:
+	getattr(reddit, name)
+seconds = time.perf_counter() - time_start
+rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps({{'seconds': seconds, 'rss_mb': rss_mb,
+                  'loaded': sorted(m for m in {heavy!r} if m in sys.modules)}}))
+'''
+
+
+def measure(modules=[], repeats=5):
+	"""Imports reddit and the given submodules in fresh interpreters.
+
+	Args:
+		modules (list, optional): submodules to import after the package
+		repeats (int, optional): number of interpreters to start
+
+	Returns:
+		dict with the best import time (s), peak RSS (MB) and the heavy modules loaded
+	"""
+
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	env = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get('PYTHONPATH', ''))
+	code = child_code.format(modules=list(modules), heavy=heavy_modules)
+
+	results = []
+	for _ in range(repeats):
+		output = subprocess.run([sys.executable, '-c', code], env=env, check=True, capture_output=True, text=True)
+		results.append(json.loads(output.stdout))
+
+	return {'seconds': min(r['seconds'] for r in results), 'rss_mb': min(r['rss_mb'] for r in results),
+	        'loaded': results[0]['loaded']}
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Benchmarks the import time and memory of the reddit package.')
+	parser.add_argument('--modules', nargs='*', default=[], help='submodules to import after the package')
+	parser.add_argument('--repeats', type=int, default=5, help='number of fresh interpreters to time')
+	parser.add_argument('--max-time', type=float, default=0.1, help='maximum import time in seconds')
+	parser.add_argument('--max-rss', type=float, default=50, help='maximum peak resident memory in MB')
+	args = parser.parse_args(argv)
+
+	result = measure(args.modules, args.repeats)
+	print('import reddit{:s}: {:0.3f} s, {:0.1f} MB, heavy modules loaded: {:s}'.format(
+		''.join(', reddit.' + m for m in args.modules), result['seconds'], result['rss_mb'],
+		', '.join(result['loaded']) or 'none'))
+
+	failed = result['seconds'] > args.max_time or result['rss_mb'] > args.max_rss
+	if not args.modules and result['loaded']:
+		print('import reddit should not load heavy modules')
+		failed = True
+
+	return 1 if failed else 0
+
+
+if __name__ == '__main__':
+	raise SystemExit(main())
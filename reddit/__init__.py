@@ -4,4 +4,23 @@
 # @Last Modified by:   joaopn
 # @Last Modified time: 2021-03-07 15:12:59
 
-from reddit import plotting, pushshift, datasets, analysis, db
\ No newline at end of file
+"""
+Submodules are imported on first access (e.g. reddit.datasets), so that importing the package does not load
+matplotlib, powerlaw, pymongo or PyTables for code that does not use them.
+"""
+
+import importlib
+
+__all__ = ['plotting', 'pushshift', 'datasets', 'analysis', 'db', 'cascades', 'pipeline']
+
+
+def __getattr__(name):
+	if name in __all__:
+		module = importlib.import_module('reddit.' + name)
+		globals()[name] = module
+		return module
+	raise AttributeError("module 'reddit' has no attribute '{:s}'".format(name))
+
+
+def __dir__():
+	return sorted(list(globals()) + __all__)
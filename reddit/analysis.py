@@ -3,10 +3,7 @@ Module for analysis functions. The functions here only take in-memory data, simp
 from the hdf5 files are hosted in the datasets module.
 """
 
-from reddit import datasets
-import pandas as pd
 import numpy as np
-import powerlaw as plw
 from itertools import combinations
 
 def get_statistics(df):
@@ -33,6 +30,8 @@ def get_statistics(df):
 
 def fit_compare(data, estimate_discrete = True, p_lim = 0.05):
 
+	import powerlaw as plw
+
 	fit_obj = plw.Fit(data, estimate_discrete=estimate_discrete)
 
 	distributions = ['power_law', 'truncated_power_law', 'exponential','lognormal_positive']
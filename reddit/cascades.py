@@ -0,0 +1,286 @@
+"""
+Module for comment cascades, the trees of comments of a thread. Cascades are built from the link_id/parent_id fields
+of the comments, either from the monthly comment dumps (RC_*) or from the comments collection of the MongoDB database.
+
+Comment ids are base36 integers, so they are stored as int64 without any lookup table. The comments are first spilled
+to n_buckets files on disk (bucketed by thread), and each bucket is then processed in memory with compact arrays:
+a CSR adjacency list of parent -> children and a level-by-level traversal from the thread roots. Buckets larger than
+max_records comments are split again on disk before processing, so peak memory is set by max_records (or by the
+largest single thread), not by the number of comments in the month.
+"""
+
+import numpy as np
+import pandas as pd
+import tempfile
+import os
+
+# Comment record written to the bucket files. parent is -1 for top-level comments (parent_id = link_id).
+record_dtype = np.dtype([('link', 'i8'), ('id', 'i8'), ('parent', 'i8')])
+
+
+def cascades_dump(file, subreddit=None, chunksize=100000, n_buckets=64, max_records=4000000, tmpdir=None):
+	"""Computes the cascade statistics of all threads in a monthly comment dump.
+
+	Args:
+		file (str): comment dump file location
+		subreddit (str, optional): only use comments from this subreddit (None for all)
+		chunksize (int, optional): size of the chunk to read
+		n_buckets (int, optional): number of bucket files the comments are spilled to
+		max_records (int, optional): maximum number of comments processed at once, larger buckets are re-split
+		tmpdir (str, optional): directory for the bucket files (None for the system default)
+
+	Returns:
+		DataFrame: see thread_statistics()
+	"""
+
+	with tempfile.TemporaryDirectory(dir=tmpdir) as bucket_dir:
+		buckets = _open_buckets(bucket_dir, n_buckets)
+
+		for df in pd.read_json(file, lines=True, chunksize=chunksize,
+		                       dtype={'id': str, 'link_id': str, 'parent_id': str, 'subreddit': str}):
+			if subreddit is not None:
+				df = df[df['subreddit'] == subreddit]
+			df = df.dropna(subset=['link_id', 'id'])
+			_write_buckets(buckets, _to_records(df['link_id'], df['id'], df['parent_id']))
+
+		return _process_buckets(buckets, max_records)
+
+
+def cascades_db(subreddit=None, db='reddit', collection='comments', batch_size=100000, n_buckets=64,
+                max_records=4000000, tmpdir=None, db_address='127.0.0.1:27017'):
+	"""Computes the cascade statistics of all threads in the comments collection, as created by db.add_data().
+
+	Args:
+		subreddit (str, optional): only use comments from this subreddit (None for all)
+		db (str): DB name
+		collection (str): collection name
+		batch_size (int, optional): number of documents per cursor batch
+		n_buckets (int, optional): number of bucket files the comments are spilled to
+		max_records (int, optional): maximum number of comments processed at once, larger buckets are re-split
+		tmpdir (str, optional): directory for the bucket files (None for the system default)
+		db_address (str): IP address of the DB
+
+	Returns:
+		DataFrame: see thread_statistics()
+	"""
+
+	from pymongo import MongoClient
+
+	client = MongoClient('mongodb://' + db_address)
+
+	query = {'link_id': {'$ne': None}, 'id': {'$ne': None}}
+	if subreddit is not None:
+		query['subreddit'] = subreddit
+	cursor = client[db][collection].find(filter=query, projection={'link_id': 1, 'id': 1, 'parent_id': 1, '_id': 0},
+	                                     batch_size=batch_size)
+
+	with tempfile.TemporaryDirectory(dir=tmpdir) as bucket_dir:
+		buckets = _open_buckets(bucket_dir, n_buckets)
+
+		batch = []
+		for doc in cursor:
+			batch.append(doc)
+			if len(batch) >= batch_size:
+				df = pd.DataFrame.from_records(batch, columns=['link_id', 'id', 'parent_id'])
+				_write_buckets(buckets, _to_records(df['link_id'], df['id'], df['parent_id']))
+				batch = []
+		if len(batch) > 0:
+			df = pd.DataFrame.from_records(batch, columns=['link_id', 'id', 'parent_id'])
+			_write_buckets(buckets, _to_records(df['link_id'], df['id'], df['parent_id']))
+
+		return _process_buckets(buckets, max_records)
+
+
+def thread_statistics(records):
+	"""Computes the size, depth and maximum breadth of each thread from an array of comment records.
+
+	Comments whose parent is not in records (e.g. deleted, or posted in another month) are attached to the thread
+	root. Comments not reachable from a root (only possible with corrupted data) are ignored.
+
+	Args:
+		records (ndarray): comment records with dtype record_dtype
+
+	Returns:
+		DataFrame: [link_id, size, depth, breadth] for each thread, where size is the number of comments, depth the
+		number of levels below the submission and breadth the largest number of comments in a single level.
+	"""
+
+	if records.size == 0:
+		return pd.DataFrame({'link_id': pd.Series(dtype=str), 'size': pd.Series(dtype='int64'),
+		                     'depth': pd.Series(dtype='int64'), 'breadth': pd.Series(dtype='int64')})
+
+	# Drops duplicated comments and integer-codes the threads
+	records = np.unique(records)
+	_, first = np.unique(records['id'], return_index=True)
+	records = records[first]
+	links, thread = np.unique(records['link'], return_inverse=True)
+	n_comments, n_threads = records.size, links.size
+
+	# Parent node of each comment. Nodes 0..n_comments-1 are comments (sorted by id), node n_comments + t is the root
+	# of thread t.
+	parent_pos = np.searchsorted(records['id'], records['parent'])
+	parent_pos = np.minimum(parent_pos, n_comments - 1)
+	parent_found = (records['parent'] >= 0) & (records['id'][parent_pos] == records['parent'])
+	parent_node = np.where(parent_found, parent_pos, n_comments + thread)
+
+	indptr, indices = csr_adjacency(parent_node, n_comments + n_threads)
+
+	# Level-by-level traversal from the roots
+	size = np.zeros(n_threads, dtype=np.int64)
+	depth = np.zeros(n_threads, dtype=np.int64)
+	breadth = np.zeros(n_threads, dtype=np.int64)
+	frontier = np.arange(n_comments, n_comments + n_threads)
+	level = 0
+	while True:
+		frontier = csr_children(indptr, indices, frontier)
+		if frontier.size == 0:
+			break
+		level += 1
+		level_count = np.bincount(thread[frontier], minlength=n_threads)
+		size += level_count
+		depth[level_count > 0] = level
+		np.maximum(breadth, level_count, out=breadth)
+
+	# Only the visited comments are counted, threads without any are dropped
+	visited = size > 0
+
+	return pd.DataFrame({'link_id': [np.base_repr(link, 36).lower() for link in links[visited]],
+	                     'size': size[visited], 'depth': depth[visited], 'breadth': breadth[visited]})
+
+
+def csr_adjacency(parent, n_nodes):
+	"""Builds the CSR adjacency list parent -> children of a forest.
+
+	Args:
+		parent (ndarray): parent node of each node in 0..parent.size-1
+		n_nodes (int): total number of nodes (nodes without a parent entry can still have children)
+
+	Returns:
+		tuple (indptr, indices): the children of node i are indices[indptr[i]:indptr[i+1]]
+	"""
+
+	indices = np.argsort(parent, kind='stable')
+	indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+	np.cumsum(np.bincount(parent, minlength=n_nodes), out=indptr[1:])
+
+	return indptr, indices
+
+
+def csr_children(indptr, indices, nodes):
+	"""Returns the concatenated children of a set of nodes from a CSR adjacency list.
+
+	Args:
+		indptr (ndarray): CSR index pointer, see csr_adjacency()
+		indices (ndarray): CSR indices, see csr_adjacency()
+		nodes (ndarray): nodes to expand
+
+	Returns:
+		ndarray: children of all nodes
+	"""
+
+	starts = indptr[nodes]
+	counts = indptr[nodes + 1] - starts
+	total = counts.sum()
+	if total == 0:
+		return np.zeros(0, dtype=np.int64)
+
+	# Position of each child in indices: starts[k] + offset within the children of nodes[k]
+	offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+
+	return indices[np.repeat(starts, counts) + offsets]
+
+
+def fit_cascades(df, fields=['size', 'depth', 'breadth'], estimate_discrete=True, p_lim=0.05):
+	"""Fits and compares the distributions of the cascade statistics with analysis.fit_compare().
+
+	Args:
+		df (DataFrame): cascade statistics, from thread_statistics()
+		fields (list, optional): statistics to fit
+		estimate_discrete (bool, optional): see analysis.fit_compare()
+		p_lim (float, optional): see analysis.fit_compare()
+
+	Returns:
+		dict of fit_compare() results for each field
+	"""
+
+	from reddit import analysis
+
+	return {field: analysis.fit_compare(np.array(df[field]), estimate_discrete=estimate_discrete, p_lim=p_lim)
+	        for field in fields}
+
+
+def _to_records(link_id, comment_id, parent_id):
+	"""Converts string link_id (t3_), id and parent_id (t1_ or t3_) Series into an array of comment records."""
+
+	records = np.empty(len(link_id), dtype=record_dtype)
+	records['link'] = [int(x[3:], 36) for x in link_id]
+	records['id'] = [int(x, 36) for x in comment_id]
+	records['parent'] = [int(x[3:], 36) if isinstance(x, str) and x.startswith('t1_') else -1 for x in parent_id]
+
+	return records
+
+
+def _open_buckets(bucket_dir, n_buckets):
+	"""Creates the empty bucket files and returns their paths."""
+
+	buckets = [os.path.join(bucket_dir, 'bucket_{:d}.bin'.format(i)) for i in range(n_buckets)]
+	for bucket in buckets:
+		open(bucket, 'wb').close()
+
+	return buckets
+
+
+def _write_buckets(buckets, records, divisor=1):
+	"""Appends comment records to the bucket of their thread, selected by (link // divisor) % len(buckets)."""
+
+	bucket_id = (records['link'] // divisor) % len(buckets)
+	for i in np.unique(bucket_id):
+		with open(buckets[i], 'ab') as f:
+			records[bucket_id == i].tofile(f)
+
+
+def _process_buckets(buckets, max_records):
+	"""Computes the thread statistics of each bucket, one bucket in memory at a time."""
+
+	results = [_process_bucket(bucket, max_records, len(buckets)) for bucket in buckets]
+
+	return pd.concat(results, ignore_index=True)
+
+
+def _process_bucket(bucket, max_records, divisor):
+	"""
+	Computes the thread statistics of a bucket file, and removes it. Buckets with more than max_records comments are
+	split into sub-buckets by link // divisor, which is independent of the link % divisor that selected the bucket,
+	and read in pieces of max_records comments. Distinct threads are eventually separated, as the divisor grows with
+	each split, so only a bucket holding a single thread is processed whole regardless of its size.
+	"""
+
+	n_records = os.path.getsize(bucket) // record_dtype.itemsize
+	offsets = range(0, n_records, max_records)
+
+	def read_piece(offset):
+		return np.fromfile(bucket, dtype=record_dtype, count=max_records, offset=offset * record_dtype.itemsize)
+
+	single_thread = False
+	if n_records > max_records:
+		link_min, link_max = np.iinfo(np.int64).max, np.iinfo(np.int64).min
+		for offset in offsets:
+			links = read_piece(offset)['link']
+			link_min, link_max = min(link_min, links.min()), max(link_max, links.max())
+		single_thread = link_min == link_max
+	if n_records <= max_records or single_thread:
+		result = thread_statistics(np.fromfile(bucket, dtype=record_dtype))
+		os.remove(bucket)
+		return result
+
+	n_split = 2 * int(np.ceil(n_records / max_records))
+	os.mkdir(bucket + '_split')
+	sub_buckets = _open_buckets(bucket + '_split', n_split)
+	for offset in offsets:
+		_write_buckets(sub_buckets, read_piece(offset), divisor)
+	os.remove(bucket)
+
+	results = [_process_bucket(sub_bucket, max_records, divisor * n_split) for sub_bucket in sub_buckets]
+	os.rmdir(bucket + '_split')
+
+	return pd.concat(results, ignore_index=True)
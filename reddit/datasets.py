@@ -11,7 +11,6 @@ processed hdf5 files.
 
 import numpy as np
 import pandas as pd
-import tables
 
 
 def load_data(subreddit, data_location, year_range, fields=['num_comments']):
@@ -73,6 +72,8 @@ def count_subreddits_h5(file, savefile):
 		DataFrame of [subreddits, submissions, comments
 	"""
 
+	import tables
+
 	load_obj = pd.HDFStore(file, mode='r', complevel=9)
 	subreddits = load_obj.keys()
 	if '/' in subreddits:
@@ -3,19 +3,39 @@ Module with functions to interface with and maintain the dataset MongoDB databas
 """
 
 from pymongo import MongoClient
+from bson import ObjectId
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
+import time
+import os
 
-def add_data(db_from, db_to, collection_from, collection_to, fields_selection, db_address=
-'127.0.0.1:27017'):
+def add_data(db_from, db_to, collection_from, collection_to, fields_selection, db_address='127.0.0.1:27017',
+             partitions=None, n_jobs=4, resume=True, sample_size=100000):
 
 	"""
 	Copies selected fields from a database collection to another.
+	If partitions is set, the source is split into that many created_utc ranges with similar numbers of documents
+	(estimated from a sample of sample_size documents), which are copied concurrently by at most n_jobs workers.
+	Documents without a numeric created_utc are copied as an additional range. The first failed range stops the copy.
+	The range edges and the state of each range are recorded in [collection_to]_copy_progress (on db_to), so an
+	interrupted copy can be resumed by calling the function again with the same partitions; the edges of the first
+	call are reused, so documents added to the source after it are not copied. Target documents are only deleted for
+	ranges that a previous call started but did not finish: those ranges are cleared from the target (including any
+	documents it held before the copy) and copied again. Requires the created_utc index from add_indexes() on both
+	collections.
 	Args:
 		db_from (str): origin database
 		db_to (str): target database
 		collection_from (str): origin collection
 		collection_to (str): target collection
 		fields_selection (str): Set of fields to copy. Valid options: 'comments','submissions'
+		db_address (str): IP address of the DB
+		partitions (int, optional): number of created_utc ranges to copy (None for a single aggregation)
+		n_jobs (int, optional): maximum number of ranges copied concurrently
+		resume (bool, optional): resume the copy recorded by a previous call (default True). With False the recorded
+			progress is discarded and nothing is cleared from the target.
+		sample_size (int, optional): number of documents sampled to place the range edges
 
 	Returns:
 		None
@@ -39,7 +59,86 @@ def add_data(db_from, db_to, collection_from, collection_to, fields_selection, d
 	{'$merge':{'into':{'db': db_to, 'coll': collection_to}}}
 	]
 
-	client[db_from][collection_from].aggregate(pipeline, **{'allowDiskUse': True})
+	if partitions is None:
+		client[db_from][collection_from].aggregate(pipeline, **{'allowDiskUse': True})
+		return
+
+	source = client[db_from][collection_from]
+	target = client[db_to][collection_to]
+	progress = client[db_to][collection_to + '_copy_progress']
+	key = {'db_from': db_from, 'collection_from': collection_from}
+
+	if not resume:
+		progress.delete_many(key)
+
+	# Splits the source in created_utc ranges [lo, hi) holding similar numbers of documents, with quantiles of a
+	# sample, as the volume grows over time. The edges are stored by the first call and reused on resume.
+	plan = progress.find_one(dict(key, plan=True))
+	if plan is not None:
+		if plan['partitions'] != partitions:
+			raise ValueError('partitions={:d} differs from the {:d} partitions of the copy being resumed, use '
+			                 'resume=False to start a new copy'.format(partitions, plan['partitions']))
+		edges = plan['edges']
+	else:
+		numeric = {'created_utc': {'$type': 'number'}}
+		oldest = source.find_one(filter=numeric, projection={'created_utc': 1}, sort=[('created_utc', 1)])
+		newest = source.find_one(filter=numeric, projection={'created_utc': 1}, sort=[('created_utc', -1)])
+		edges = []
+		if oldest is not None:
+			sample = [doc['created_utc'] for doc in source.aggregate([
+				{'$match': numeric},
+				{'$sample': {'size': sample_size}},
+				{'$project': {'created_utc': 1, '_id': 0}}], **{'allowDiskUse': True})]
+			quantiles = np.quantile(sample, np.linspace(0, 1, partitions + 1)[1:-1]) if sample else []
+			edges = np.unique(np.concatenate([[np.floor(oldest['created_utc'])], np.floor(quantiles),
+			                                  [np.floor(newest['created_utc']) + 1]]).astype(np.int64)).tolist()
+		progress.insert_one(dict(key, plan=True, partitions=partitions, edges=edges))
+
+	# Documents whose created_utc is missing, null or not a number (e.g. strings in old dumps) are copied as a final
+	# range of their own, with lo = hi = None
+	ranges = list(zip(edges[:-1], edges[1:])) + [(None, None)]
+	state = {(doc['lo'], doc['hi']): doc['done'] for doc in progress.find(dict(key, plan=False))}
+	ranges_left = [r for r in ranges if not state.get(r, False)]
+
+	print('Copying {:d} of {:d} ranges with {:d} workers'.format(len(ranges_left), len(ranges), n_jobs))
+
+	def copy_range(lo, hi):
+		if lo is None:
+			match = {'created_utc': {'$not': {'$type': 'number'}}}
+		else:
+			match = {'created_utc': {'$gte': lo, '$lt': hi}}
+		range_key = dict(key, plan=False, lo=lo, hi=hi)
+		time_start = time.time()
+
+		# Removes the partial output of a copy of this range that was interrupted
+		if (lo, hi) in state:
+			target.delete_many(match)
+		progress.replace_one(range_key, dict(range_key, done=False), upsert=True)
+
+		n_before = target.count_documents(match)
+		source.aggregate([{'$match': match}] + pipeline, **{'allowDiskUse': True})
+		n_docs = target.count_documents(match) - n_before
+
+		time_elapsed = time.time() - time_start
+		progress.replace_one(range_key, dict(range_key, done=True, documents=n_docs, seconds=time_elapsed))
+		return n_docs, time_elapsed
+
+	# Stops at the first failed range, cancelling the ranges not started yet
+	with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+		futures = {executor.submit(copy_range, lo, hi): (lo, hi) for lo, hi in ranges_left}
+		for i, future in enumerate(as_completed(futures)):
+			lo, hi = futures[future]
+			try:
+				n_docs, time_elapsed = future.result()
+			except Exception:
+				executor.shutdown(wait=False, cancel_futures=True)
+				raise
+			if lo is None:
+				str_range = 'created_utc not a number'
+			else:
+				str_range = 'created_utc [{:d}, {:d})'.format(lo, hi)
+			print('[{:d}/{:d}] {:s}: {:d} documents in {:0.0f} s ({:0.0f} docs/s)'.format(
+				i + 1, len(ranges_left), str_range, n_docs, time_elapsed, n_docs / max(time_elapsed, 1e-9)))
 
 def add_collection(collection, db, db_address=
 '127.0.0.1:27017'):
@@ -78,28 +177,108 @@ def get_num_comments(subreddit, db='reddit', collection='submissions', batch_siz
 	return np.array([x['num_comments'] for x in result_list])
 
 
-def add_subreddit_statistics(db='reddit', collection='submissions', db_address='127.0.0.1:27017'):
+def add_indexes(db='reddit', collection='submissions', fields_selection='submissions', db_address=
+'127.0.0.1:27017'):
+	"""
+	Ensures the indexes used by the query functions of this module exist. For submissions, the compound index
+	(subreddit, created_utc, num_comments) covers get_num_comments() and get_subreddit_count_single(), and the
+	created_utc index serves the partitioned copy of add_data() and (subreddit, _id) the streaming of export_hdf5().
+	Creating an existing index is a no-op.
+	Args:
+		db (str): DB name
+		collection (str): collection name
+		fields_selection (str): Set of indexes to create. Valid options: 'comments','submissions'
+		db_address (str): IP address of the DB
+
+	Returns:
+		list of created index names
+	"""
+
+	if fields_selection == 'submissions':
+		indexes = [[('subreddit', 1), ('created_utc', 1), ('num_comments', 1)],
+		           [('subreddit', 1), ('_id', 1)],
+		           [('created_utc', 1)]]
+	elif fields_selection == 'comments':
+		indexes = [[('subreddit', 1), ('created_utc', 1)],
+		           [('link_id', 1)],
+		           [('created_utc', 1)]]
+	else:
+		raise ValueError('field_selection must be "comments" or "submissions"')
+
+	client = MongoClient('mongodb://' + db_address)
+
+	return [client[db][collection].create_index(index, background=True) for index in indexes]
+
+
+def add_subreddit_statistics(db='reddit', collection='submissions', db_address='127.0.0.1:27017', incremental=True):
 	"""
 	Updates the db collection [collection]_statistics, which stores # of submissions and comments in the subreddit.
+	In incremental mode, only documents inserted after the last update are aggregated and merged into the existing
+	statistics, so the cost is proportional to the new data. Insertion order is taken from the ObjectId _id generated
+	when the documents are inserted (e.g. by add_data()), so documents copied out of created_utc order are still
+	counted. The _id watermark is stored in [collection]_statistics_meta, together with a pending marker while an
+	update runs: if an update was interrupted, the next call does a full rebuild instead of merging the same
+	documents twice. Changes to documents already counted (e.g. updated num_comments) are only picked up by a full
+	rebuild (incremental=False), which counts all documents and should run while no documents are being inserted.
 	Args:
 		db (str): DB name
 		collection (str): collection name
 		db_address (str): IP address of the DB
+		incremental (bool, optional): merge only new documents into the existing statistics (default True)
 
 	"""
 	client = MongoClient('mongodb://' + db_address)
+	meta = client[db][collection + '_statistics_meta']
+
+	watermark = None
+	if incremental:
+		watermark_doc = meta.find_one({'_id': 'watermark'})
+		if watermark_doc is not None and watermark_doc.get('pending') is None:
+			watermark = watermark_doc.get('object_id')
+
+	# Fixes the upper bound first, so documents inserted during the aggregation are left for the next update. The full
+	# rebuild counts everything, so its watermark is the start time itself.
+	match = {'subreddit': {'$ne': None}}
+	if watermark is not None:
+		watermark_new = _insertion_bound(client)
+		match['_id'] = {'$gte': watermark, '$lt': watermark_new}
+	else:
+		watermark_new = _insertion_bound(client, delay=0)
 
 	pipeline = [
-    {'$match': {'subreddit': {'$ne': None}}},
+		{'$match': match},
 		{'$project': {'subreddit': 1, '_id': 0, 'num_comments': 1}},
 		{'$group': {'_id': '$subreddit',
 		            'submissions': {'$sum': 1},
-		            'comments': {'$sum': '$num_comments'}}},
-		{'$sort': {'submissions': -1}},
-		{'$out': 'subreddit_statistics'}]
+		            'comments': {'$sum': '$num_comments'}}}]
+
+	if watermark is None:
+		pipeline += [
+			{'$sort': {'submissions': -1}},
+			{'$out': collection + '_statistics'}]
+	else:
+		pipeline += [
+			{'$merge': {'into': collection + '_statistics',
+			            'on': '_id',
+			            'whenMatched': [{'$set': {'submissions': {'$add': ['$submissions', '$$new.submissions']},
+			                                      'comments': {'$add': ['$comments', '$$new.comments']}}}],
+			            'whenNotMatched': 'insert'}}]
+
+	meta.update_one({'_id': 'watermark'}, {'$set': {'pending': watermark_new}}, upsert=True)
 
 	client[db][collection].aggregate(pipeline, **{'allowDiskUse': True})
 
+	meta.replace_one({'_id': 'watermark'}, {'_id': 'watermark', 'object_id': watermark_new}, upsert=True)
+
+
+def _insertion_bound(client, delay=60):
+	"""
+	Returns the ObjectId bound below which all documents were inserted more than delay seconds ago, by the clock of
+	the DB server. Documents still being inserted (e.g. by a running add_data()) are left above the bound.
+	"""
+	server_time = client.admin.command('hello')['localTime']
+	return ObjectId.from_datetime(server_time - timedelta(seconds=delay))
+
 
 def get_subreddit_statistics(db='reddit', collection='submissions', batch_size=1000000, db_address='127.0.0.1:27017'):
 	"""
@@ -145,3 +324,120 @@ def get_subreddit_count_single(subreddit, db='reddit', collection='submissions',
 	]
 	result = client[db][collection].aggregate(pipeline,**{'allowDiskUse': True, 'batchSize':batch_size})
 	return list(result)
+
+
+def export_hdf5(savefile, catalog_file=None, db='reddit', collection='submissions', incremental=True,
+                chunksize=1000000, batch_size=100000, db_address='127.0.0.1:27017'):
+	"""
+	Exports a submissions collection to the per-subreddit HDF5 format of datasets.subreddits_hdf5(), where each group
+	is a subreddit. The collection is streamed sorted by subreddit and written in chunks of chunksize documents, so
+	memory use does not depend on the collection size. In incremental mode, only documents inserted after the last
+	export (by their ObjectId _id) are appended; otherwise savefile is overwritten. The _id bounds of the export are
+	stored in the file root, and the last _id written to each subreddit in its group, so an interrupted export is
+	resumed by calling the function again, without duplicating documents. Files not written by this function (e.g.
+	by datasets.subreddits_hdf5()) cannot be updated incrementally. Requires the (subreddit, _id) index from
+	add_indexes().
+	Args:
+		savefile (str): HDF5 file location
+		catalog_file (str, optional): csv file with [name, submissions, comments] for each subreddit, as written by
+			datasets.count_subreddits_h5(). Updated with the exported documents.
+		db (str): DB name
+		collection (str): collection name
+		incremental (bool, optional): only export documents inserted after the last export (default True)
+		chunksize (int, optional): number of documents to write at once
+		batch_size (int, optional): number of documents per cursor batch
+		db_address (str): IP address of the DB
+
+	Returns:
+		int: number of exported documents
+	"""
+
+	fields = ['subreddit', 'author', 'domain', 'created_utc', 'num_comments', 'score', 'id']
+	field_dtypes = {'subreddit': str, 'author': str, 'domain': str, 'created_utc': int, 'num_comments': int,
+	                'score': int, 'id': str}
+
+	import pandas as pd
+
+	file_exists = os.path.isfile(savefile)
+	client = MongoClient('mongodb://' + db_address)
+	save_obj = pd.HDFStore(savefile, mode='a' if incremental else 'w', complevel=9)
+	try:
+		attrs = save_obj.get_node('/')._v_attrs
+
+		if incremental and file_exists and 'export_id' not in attrs and 'export_id_pending' not in attrs:
+			raise ValueError(savefile + ' was not written by export_hdf5(), use incremental=False to overwrite it')
+
+		# The watermarks are ObjectId hex strings, which sort as the ObjectIds. An interrupted export is resumed with
+		# its upper bound, otherwise it is fixed now so documents inserted during the export are left for the next one.
+		watermark = attrs['export_id'] if incremental and 'export_id' in attrs else None
+		if incremental and 'export_id_pending' in attrs:
+			watermark_new = attrs['export_id_pending']
+		else:
+			watermark_new = str(_insertion_bound(client))
+			attrs['export_id_pending'] = watermark_new
+			save_obj.flush()
+
+		query = {'subreddit': {'$ne': None}, '_id': {'$lt': ObjectId(watermark_new)}}
+		if watermark is not None:
+			query['_id']['$gte'] = ObjectId(watermark)
+
+		projection = {field: 1 for field in fields}
+		cursor = client[db][collection].find(filter=query, projection=projection, batch_size=batch_size,
+		                                     sort=[('subreddit', 1), ('_id', 1)])
+
+		def save_chunk(chunk):
+			df = pd.DataFrame.from_records(chunk, columns=fields + ['_id'])
+			df['_id'] = df['_id'].astype(str)
+			df = df.fillna({field: '' if dtype is str else 0 for field, dtype in field_dtypes.items()})
+			df = df.astype(field_dtypes)
+			for subreddit, df_subreddit in df.groupby('subreddit', sort=False):
+				key = '/' + subreddit
+
+				# Skips the documents already written by an interrupted run of this export
+				if key in save_obj and 'export_id' in save_obj.get_storer(key).attrs:
+					df_subreddit = df_subreddit[df_subreddit['_id'] > save_obj.get_storer(key).attrs['export_id']]
+				if len(df_subreddit) == 0:
+					continue
+
+				save_obj.put(key, df_subreddit[fields], append=True, format='table', min_itemsize=255)
+				save_obj.get_storer(key).attrs['export_id'] = df_subreddit['_id'].iloc[-1]
+			save_obj.flush()
+
+			# Counts all documents of the export interval, as the catalog is only updated once the export completes
+			return df.groupby('subreddit')['num_comments'].agg(['size', 'sum'])
+
+		counts = []
+		chunk = []
+		n_docs = 0
+		for doc in cursor:
+			chunk.append(doc)
+			if len(chunk) >= chunksize:
+				counts.append(save_chunk(chunk))
+				n_docs += len(chunk)
+				chunk = []
+		if len(chunk) > 0:
+			counts.append(save_chunk(chunk))
+			n_docs += len(chunk)
+
+		# Updates the catalog, unless an interrupted run of this export already did
+		catalog_done = 'export_catalog_id' in attrs and attrs['export_catalog_id'] == watermark_new
+		if catalog_file is not None and not catalog_done:
+			catalog = pd.DataFrame(columns=['submissions', 'comments'], dtype='int64')
+			if counts:
+				catalog = pd.concat(counts).groupby(level=0).sum().rename(columns={'size': 'submissions',
+				                                                                   'sum': 'comments'})
+			if watermark is not None and os.path.isfile(catalog_file):
+				catalog_old = pd.read_csv(catalog_file, index_col='name')
+				catalog = catalog_old.add(catalog, fill_value=0).astype('int64')
+			catalog.index.name = 'name'
+			catalog.sort_values('submissions', ascending=False).to_csv(catalog_file + '.tmp')
+			os.replace(catalog_file + '.tmp', catalog_file)
+			attrs['export_catalog_id'] = watermark_new
+			save_obj.flush()
+
+		attrs['export_id'] = watermark_new
+		del attrs['export_id_pending']
+	finally:
+		save_obj.close()
+
+	return n_docs
@@ -0,0 +1,276 @@
+"""
+Command-line pipeline for the submission dumps: ingest (datasets.subreddits_hdf5), stats (datasets.count_subreddits_h5),
+fit (datasets.load_data + analysis.fit_compare) and plot (plotting.powerlaw).
+
+Each stage is a set of tasks with input and output files. Tasks form a dependency graph through their files, and a
+task is skipped if all its outputs are newer than all its inputs, so adding a monthly dump only reruns the work that
+reads it. Independent tasks run in parallel on a process pool, and the time of every task is appended to a csv file.
+
+Usage:
+	python -m reddit.pipeline --dumps DUMP_DIR --data H5_DIR --results RESULTS_DIR --subreddits askscience science
+"""
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+import argparse
+import csv
+import glob
+import os
+import time
+
+stages = ['ingest', 'stats', 'fit', 'plot']
+
+
+class Task:
+	"""A unit of work of the pipeline.
+
+	Args:
+		name (str): unique task name
+		stage (str): stage the task belongs to
+		func (callable): module-level function run on the worker pool as func(*args)
+		args (tuple): arguments of func
+		inputs (list): files read by the task
+		outputs (list): files written by the task
+	"""
+
+	def __init__(self, name, stage, func, args, inputs, outputs):
+		self.name = name
+		self.stage = stage
+		self.func = func
+		self.args = args
+		self.inputs = inputs
+		self.outputs = outputs
+
+	def up_to_date(self):
+		"""Returns True if all outputs exist and are newer than all existing inputs."""
+
+		if not all(os.path.isfile(file) for file in self.outputs):
+			return False
+		inputs_time = [os.path.getmtime(file) for file in self.inputs if os.path.isfile(file)]
+		if len(inputs_time) == 0:
+			return True
+
+		return min(os.path.getmtime(file) for file in self.outputs) >= max(inputs_time)
+
+
+def build_tasks(dumps, data, results, subreddits, year_range, stages_run=stages):
+	"""Builds the pipeline tasks from the monthly submission dumps found in a directory.
+
+	Args:
+		dumps (str): directory with the submission dumps (RS_*)
+		data (str): directory for the hdf5 files, one per dump
+		results (str): directory for the statistics, fits and plots
+		subreddits (list): subreddits to fit and plot
+		year_range (tuple): (first, last) years used by the fits and plots
+		stages_run (list, optional): stages to build tasks for
+
+	Returns:
+		list of Task
+	"""
+
+	tasks = []
+
+	# Dumps are matched to hdf5 files by name, dropping the extension (RS_2015-01.bz2 -> RS_2015-01)
+	h5_files = {}
+	for dump in sorted(glob.glob(os.path.join(dumps, 'RS_*'))):
+		name = os.path.basename(dump).split('.')[0]
+		h5_files[name] = os.path.join(data, name)
+		if 'ingest' in stages_run:
+			tasks.append(Task('ingest:' + name, 'ingest', _run_ingest, (dump, h5_files[name]), [dump],
+			                  [h5_files[name]]))
+
+	if 'stats' in stages_run:
+		for name, h5_file in h5_files.items():
+			counts_file = os.path.join(results, 'counts', name + '.csv')
+			tasks.append(Task('stats:' + name, 'stats', _run_stats, (h5_file, counts_file), [h5_file], [counts_file]))
+
+	# Fits and plots read the hdf5 files of year_range listed by datasets.submission_filenames(), through
+	# datasets.load_data()
+	from reddit import datasets
+	import numpy as np
+
+	YEAR_MIN, YEAR_MAX = year_range
+	h5_range = datasets.submission_filenames(np.arange(YEAR_MIN, YEAR_MAX + 1), path=os.path.join(data, ''))
+
+	for subreddit in subreddits:
+		if 'fit' in stages_run:
+			fit_file = os.path.join(results, 'fits', subreddit + '.json')
+			tasks.append(Task('fit:' + subreddit, 'fit', _run_fit, (subreddit, data, year_range, fit_file), h5_range,
+			                  [fit_file]))
+		if 'plot' in stages_run:
+			plot_file = os.path.join(results, 'plots', subreddit + '.png')
+			tasks.append(Task('plot:' + subreddit, 'plot', _run_plot, (subreddit, data, year_range, plot_file),
+			                  h5_range, [plot_file]))
+
+	return tasks
+
+
+def run(tasks, n_jobs=4, timings_file=None, dry_run=False):
+	"""Runs the tasks in dependency order, skipping the up-to-date ones.
+
+	A task depends on the tasks that write its inputs, and is only checked once those have finished. Tasks whose
+	dependencies failed are not run.
+
+	Args:
+		tasks (list): list of Task
+		n_jobs (int, optional): number of worker processes
+		timings_file (str, optional): csv file each task timing is appended to as the task finishes
+		dry_run (bool, optional): only print the tasks that would run, with status 'would run'
+
+	Returns:
+		list of dict results containing {'task', 'stage', 'status', 'seconds'}
+	"""
+
+	producer = {output: task.name for task in tasks for output in task.outputs}
+	dependencies = {task.name: {producer[file] for file in task.inputs if file in producer} for task in tasks}
+	pending = {task.name: task for task in tasks}
+	status = {}
+	timings = []
+
+	def record(task, task_status, seconds):
+		status[task.name] = task_status
+		row = {'time': datetime.now().isoformat(timespec='seconds'), 'task': task.name, 'stage': task.stage,
+		       'status': task_status, 'seconds': seconds}
+		timings.append(row)
+		print('{:s} {:s} ({:0.1f} s)'.format(task.name, task_status, seconds))
+
+		# Appended as each task finishes, so the timings survive an interrupted run
+		if timings_file is not None and not dry_run:
+			write_header = not os.path.isfile(timings_file)
+			with open(timings_file, 'a', newline='') as f:
+				writer = csv.DictWriter(f, fieldnames=list(row))
+				if write_header:
+					writer.writeheader()
+				writer.writerow(row)
+
+	with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+		running = {}
+		while pending or running:
+
+			# Schedules the tasks whose dependencies have all finished
+			for name in list(pending):
+				task = pending[name]
+				if not dependencies[name].issubset(status):
+					continue
+				del pending[name]
+				if any(status[dep] in ['failed', 'cancelled'] for dep in dependencies[name]):
+					record(task, 'cancelled', 0)
+				elif task.up_to_date() and not any(status[dep] in ['done', 'would run'] for dep in dependencies[name]):
+					record(task, 'skipped', 0)
+				elif dry_run:
+					record(task, 'would run', 0)
+				else:
+					for output in task.outputs:
+						os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+					running[executor.submit(_timed, task.func, task.args)] = task
+
+			if not running:
+				if pending and not any(dependencies[name].issubset(status) for name in pending):
+					raise ValueError('Cyclic dependencies between tasks: ' + ', '.join(pending))
+				continue
+
+			finished, _ = wait(running, return_when=FIRST_COMPLETED)
+			for future in finished:
+				task = running.pop(future)
+				seconds, error = future.result()
+				if error is None:
+					record(task, 'done', seconds)
+				else:
+					print('{:s} failed: {:s}'.format(task.name, error))
+					record(task, 'failed', seconds)
+
+	return timings
+
+
+def _timed(func, args):
+	"""Runs func(*args) and returns the elapsed time in seconds and the error raised (None if it succeeded)."""
+
+	time_start = time.time()
+	try:
+		func(*args)
+		error = None
+	except Exception as e:
+		error = repr(e)
+	return time.time() - time_start, error
+
+
+def _run_ingest(dump, savefile):
+	"""Ingest task: parses a submission dump into an hdf5 file."""
+
+	from reddit import datasets
+
+	# subreddits_hdf5 appends, so the file is written from scratch and moved into place when complete
+	tmpfile = savefile + '.tmp'
+	if os.path.isfile(tmpfile):
+		os.remove(tmpfile)
+	datasets.subreddits_hdf5(dump, tmpfile)
+	os.replace(tmpfile, savefile)
+
+
+def _run_stats(h5_file, savefile):
+	"""Stats task: counts submissions and comments per subreddit of an hdf5 file."""
+
+	from reddit import datasets
+	datasets.count_subreddits_h5(h5_file, savefile)
+
+
+def _run_fit(subreddit, data, year_range, savefile):
+	"""Fit task: saves the fit_compare() results of the number of comments of a subreddit to json."""
+
+	from reddit import datasets, analysis
+	import numpy as np
+	import pandas as pd
+
+	df = datasets.load_data(subreddit, os.path.join(data, ''), year_range)
+	comments = np.array(df['num_comments'])
+	pd.Series(analysis.fit_compare(comments[comments > 0])).to_json(savefile)
+
+
+def _run_plot(subreddit, data, year_range, savefile):
+	"""Plot task: saves the number of comments distribution of a subreddit with its power-law fit."""
+
+	import matplotlib
+	matplotlib.use('Agg')
+	import matplotlib.pyplot as plt
+	import numpy as np
+	from reddit import datasets, plotting
+
+	df = datasets.load_data(subreddit, os.path.join(data, ''), year_range)
+	fig, ax = plt.subplots()
+	plotting.powerlaw(np.array(df['num_comments']), ax=ax)
+	ax.set_xscale('log')
+	ax.set_yscale('log')
+	ax.set_title('r/' + subreddit)
+	ax.legend()
+	fig.savefig(savefile)
+	plt.close(fig)
+
+
+def main(argv=None):
+	"""Command-line entry point, returns the exit code."""
+
+	parser = argparse.ArgumentParser(description='Runs the out-of-date stages of the reddit power-law pipeline.')
+	parser.add_argument('--dumps', required=True, help='directory with the monthly submission dumps (RS_*)')
+	parser.add_argument('--data', required=True, help='directory for the hdf5 files')
+	parser.add_argument('--results', required=True, help='directory for the statistics, fits and plots')
+	parser.add_argument('--subreddits', nargs='*', default=[], help='subreddits to fit and plot')
+	parser.add_argument('--years', nargs=2, type=int, default=[2005, 2020], metavar=('FIRST', 'LAST'),
+	                    help='year range of the fits and plots')
+	parser.add_argument('--stages', nargs='*', default=stages, choices=stages, help='stages to run')
+	parser.add_argument('-j', '--jobs', type=int, default=4, help='number of worker processes')
+	parser.add_argument('--timings', default=None, help='csv file the task timings are appended to '
+	                                                    '(default RESULTS/timings.csv)')
+	parser.add_argument('-n', '--dry-run', action='store_true', help='only print the tasks that would run')
+	args = parser.parse_args(argv)
+
+	timings_file = args.timings or os.path.join(args.results, 'timings.csv')
+	os.makedirs(os.path.dirname(timings_file) or '.', exist_ok=True)
+
+	tasks = build_tasks(args.dumps, args.data, args.results, args.subreddits, tuple(args.years), args.stages)
+	timings = run(tasks, n_jobs=args.jobs, timings_file=timings_file, dry_run=args.dry_run)
+
+	return 1 if any(t['status'] in ['failed', 'cancelled'] for t in timings) else 0
+
+
+if __name__ == '__main__':
+	raise SystemExit(main())
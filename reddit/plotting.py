@@ -5,8 +5,6 @@
 # @Last Modified time: 2021-03-09 15:55:27
 
 import powerlaw as plw
-import seaborn as sns
-from reddit import pushshift
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
@@ -76,6 +74,9 @@ def subreddits_live(subreddit_list, date_min, date_max=None):
 		date_max (str, optional): Youngest post to get, in the ISO format
 	"""
 
+	import seaborn as sns
+	from reddit import pushshift
+
 	df = pd.DataFrame()
 	# Downloads data
 	for subreddit in subreddit_list: